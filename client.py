@@ -1,28 +1,153 @@
+import os
 import socket
-import json
 import time
 import uuid
+import queue
+import random
 import logging
-from typing import Any, Optional, Dict
+import threading
+from typing import Any, Callable, Optional, Dict, List, Tuple
 from datetime import datetime
 
+from protocol import CODECS, FORMAT_JSON, FORMAT_MSGPACK, encode_frames, frame, recv_msg
+
+# Per-request logs are emitted at DEBUG; set RPC_LOG_LEVEL=DEBUG to see them.
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.environ.get('RPC_LOG_LEVEL', 'INFO').upper(),
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+_PREFERRED_FORMAT = FORMAT_MSGPACK if FORMAT_MSGPACK in CODECS else FORMAT_JSON
+
+MAX_BACKOFF = 8
+RECV_BUFFER_SIZE = 65536
+# Batches up to this size fit in the socket buffers, so they are written
+# inline without a sender thread.
+INLINE_BATCH_BYTES = 65536
+
+# (socket, wire format, whether the format byte still has to go out with the
+# first frame and its answer be read before the first response)
+_Conn = Tuple[socket.socket, bytes, bool]
+
+class _FormatDeclined(ConnectionError):
+    pass
+
+def _send_all(sock: socket.socket, data: bytes, errors: List[Exception]):
+    try:
+        sock.sendall(data)
+    except Exception as e:
+        errors.append(e)
+
+def _encode_error(request_id: str, error: Exception, ts: str) -> Dict:
+    return {
+        'request_id': request_id,
+        'error': f'Cannot encode request: {error}',
+        'status': 'ENCODE_ERROR',
+        'attempts': 0,
+        'client_timestamp': ts
+    }
+
 class RPCClient:
-    def __init__(self, server_host: str, server_port: int = 5000):
+    def __init__(self, server_host: str, server_port: int = 5000, pool_size: int = 8):
         self.server_host = server_host
         self.server_port = server_port
         self.timeout = 2
         self.max_retries = 3
         self.retry_delay = 1
+        self.pool_size = pool_size
         self.client_id = str(uuid.uuid4())[:8]
+        self._pool: queue.Queue = queue.Queue(maxsize=pool_size)
+        self._local = threading.local()
+        self._format = _PREFERRED_FORMAT
+        # Set once a server has answered a format byte
+        self._format_known = False
         
-        logging.info(f"RPC Client {self.client_id} initialized")
-        logging.info(f"Server: {self.server_host}:{self.server_port}")
-        logging.info(f"Timeout: {self.timeout}s, Max retries: {self.max_retries}")
+        logging.info("RPC Client %s initialized", self.client_id)
+        logging.info("Server: %s:%s", self.server_host, self.server_port)
+        logging.info("Timeout: %ss, Max retries: %d, Pool size: %d", self.timeout, self.max_retries, self.pool_size)
+    
+    def _connect(self, port: int) -> _Conn:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if hasattr(socket, 'TCP_NODELAY'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(self.timeout)
+        requested = self._format
+        try:
+            sock.connect((self.server_host, port))
+            if self._format_known:
+                # The format byte rides along with the first frame, so only
+                # the first connection pays a round trip for the handshake.
+                return sock, requested, True
+            sock.sendall(requested)
+            wire_format = self._read_format_ack(sock, requested)
+        except Exception:
+            sock.close()
+            raise
+        return sock, wire_format, False
+    
+    def _read_format_ack(self, sock: socket.socket, requested: bytes) -> bytes:
+        wire_format = sock.recv(1)
+        if not wire_format:
+            raise ConnectionError("Empty response")
+        if wire_format not in CODECS:
+            raise ConnectionError(f"Server chose unsupported wire format {wire_format!r}")
+        self._format_known = True
+        if wire_format != requested:
+            # Later connections ask for what this server supports straight away
+            logging.info("Server declined wire format %r, using %r", requested, wire_format)
+            self._format = wire_format
+        return wire_format
+    
+    def _confirm_format(self, sock: socket.socket, sent: bytes):
+        # Reads the answer to a format byte sent along with the first frame
+        if self._read_format_ack(sock, sent) != sent:
+            # The frames already sent were encoded for the wrong format
+            raise _FormatDeclined(f"Server declined wire format {sent!r}")
+    
+    def _recv_buffer(self) -> bytearray:
+        # A socket is only read by the thread that acquired it until it is
+        # released, so one receive buffer per calling thread is never shared.
+        try:
+            return self._local.buf
+        except AttributeError:
+            buf = self._local.buf = bytearray(RECV_BUFFER_SIZE)
+            return buf
+    
+    def _acquire(self) -> Tuple[_Conn, bool]:
+        # Also reports whether the connection was reused from the pool
+        try:
+            return self._pool.get_nowait(), True
+        except queue.Empty:
+            return self._connect(self.server_port), False
+    
+    def _release(self, conn: _Conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn[0].close()
+    
+    def _reconnect_stale(self, sock: socket.socket) -> Tuple[_Conn, bool]:
+        # A pooled connection died before answering, most likely because the
+        # server closed it while idle (e.g. on restart). The rest of the pool
+        # is probably stale as well, so drop it and retry right away on a
+        # fresh connection without spending an attempt.
+        logging.info("Pooled connection was closed by the server, reconnecting")
+        sock.close()
+        self.close()
+        return self._connect(self.server_port), False
+    
+    def _backoff(self, attempt: int):
+        # Exponential backoff with jitter so clients that failed together
+        # do not all retry in lockstep.
+        delay = min(self.retry_delay * (2 ** attempt), MAX_BACKOFF) * (0.5 + random.random())
+        time.sleep(delay)
+    
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait()[0].close()
+            except queue.Empty:
+                break
     
     def call(
         self,
@@ -34,105 +159,300 @@ class RPCClient:
     ) -> Dict:
         if request_id is None:
             request_id = str(uuid.uuid4())
+        ts = datetime.now().isoformat()
         
         request = {
             'request_id': request_id,
             'method': method,
             'params': params,
-            'timestamp': datetime.now().isoformat(),
+            'timestamp': ts,
             'client_id': self.client_id
         }
         
         port = self.server_port
         if simulate_failure:
             port = 9999
-            logging.warning(f"[{request_id}] Using wrong port {port}")
+            logging.warning("[%s] Using wrong port %d", request_id, port)
+        
+        pooled = port == self.server_port
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        
+        # Encode once up front: an unencodable request fails the same way on
+        # every attempt, so it is reported immediately instead of retried.
+        wire_format = self._format
+        try:
+            payload = CODECS[wire_format][0](request)
+        except Exception as e:
+            return _encode_error(request_id, e, ts)
         
         for attempt in range(self.max_retries):
             attempt_num = attempt + 1
-            logging.info(f"[{request_id}] Attempt {attempt_num}/{self.max_retries}")
+            if debug:
+                logging.debug("[%s] Attempt %d/%d", request_id, attempt_num, self.max_retries)
             start_time = time.time()
+            sock = None
             
             try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(self.timeout)
-                sock.connect((self.server_host, port))
-                sock.send(json.dumps(request).encode('utf-8'))
-                
-                response_data = sock.recv(4096)
+                conn, reused = self._acquire() if pooled else (self._connect(port), False)
+                while True:
+                    sock, conn_format, ack_pending = conn
+                    if conn_format != wire_format:
+                        # The server negotiated a different format since we encoded
+                        wire_format = conn_format
+                        try:
+                            payload = CODECS[wire_format][0](request)
+                        except Exception as e:
+                            if pooled:
+                                self._release(conn)
+                            else:
+                                sock.close()
+                            return _encode_error(request_id, e, ts)
+                    try:
+                        if ack_pending:
+                            sock.sendall(conn_format + frame(payload))
+                            self._confirm_format(sock, conn_format)
+                            conn = (sock, conn_format, False)
+                        else:
+                            sock.sendall(frame(payload))
+                        response_data = recv_msg(sock, self._recv_buffer())
+                        if not response_data:
+                            raise ConnectionError("Empty response")
+                        break
+                    except _FormatDeclined:
+                        # Resend at once, encoded for the format the server chose
+                        sock.close()
+                        conn, reused = self._connect(port), False
+                        continue
+                    except ConnectionError:
+                        if not reused:
+                            raise
+                    conn, reused = self._reconnect_stale(sock)
                 latency = time.time() - start_time
                 
-                if not response_data:
-                    raise ConnectionError("Empty response")
-                
-                response = json.loads(response_data.decode('utf-8'))
+                response = CODECS[conn_format][1](response_data)
                 response['latency'] = f"{latency:.3f}s"
                 response['attempt'] = attempt_num
-                response['client_timestamp'] = request['timestamp']
-                sock.close()
+                response['client_timestamp'] = ts
+                if pooled:
+                    self._release(conn)
+                else:
+                    sock.close()
+                sock = None
                 
                 if response.get('status') == 'OK':
-                    logging.info(f"[{request_id}] SUCCESS")
+                    if debug:
+                        logging.debug("[%s] SUCCESS on attempt %d", request_id, attempt_num)
                     return response
                 else:
                     return response
                     
             except socket.timeout:
-                logging.warning(f"[{request_id}] TIMEOUT on attempt {attempt_num}")
+                if sock is not None:
+                    sock.close()
+                logging.warning("[%s] TIMEOUT on attempt %d", request_id, attempt_num)
                 if attempt_num < self.max_retries:
-                    time.sleep(self.retry_delay)
+                    self._backoff(attempt)
                 else:
                     return {
                         'request_id': request_id,
                         'error': f'Max retries exceeded after {self.max_retries}',
                         'status': 'TIMEOUT_ERROR',
                         'attempts': attempt_num,
-                        'client_timestamp': request['timestamp']
+                        'client_timestamp': ts
                     }
                     
             except ConnectionRefusedError:
-                logging.error(f"[{request_id}] CONNECTION REFUSED")
+                if sock is not None:
+                    sock.close()
+                logging.error("[%s] CONNECTION REFUSED", request_id)
                 if attempt_num < self.max_retries:
-                    time.sleep(self.retry_delay)
+                    self._backoff(attempt)
                 else:
                     return {
                         'request_id': request_id,
                         'error': 'Connection refused',
                         'status': 'CONNECTION_ERROR',
                         'attempts': attempt_num,
-                        'client_timestamp': request['timestamp']
+                        'client_timestamp': ts
                     }
                     
             except Exception as e:
-                logging.error(f"[{request_id}] ERROR: {e}")
+                if sock is not None:
+                    sock.close()
+                logging.error("[%s] ERROR: %s", request_id, e)
                 if attempt_num < self.max_retries:
-                    time.sleep(self.retry_delay)
+                    self._backoff(attempt)
                 else:
                     return {
                         'request_id': request_id,
                         'error': str(e),
                         'status': 'UNKNOWN_ERROR',
                         'attempts': attempt_num,
-                        'client_timestamp': request['timestamp']
+                        'client_timestamp': ts
                     }
         
         return {
             'request_id': request_id,
             'error': 'Fatal error',
             'status': 'FATAL_ERROR',
-            'client_timestamp': request['timestamp']
+            'client_timestamp': ts
         }
 
+    def _exchange_batch(
+        self, sock: socket.socket, frames: bytes, count: int,
+        loads: Callable[[memoryview], Any], responses: Dict, ack_format: Optional[bytes]
+    ):
+        if ack_format is not None:
+            frames = ack_format + frames
+        sender = None
+        send_errors = []
+        if len(frames) <= INLINE_BATCH_BYTES:
+            sock.sendall(frames)
+        else:
+            # The server answers while we are still sending; with nobody
+            # reading, both sides would block on full socket buffers. A
+            # helper thread sends while this one reads.
+            sender = threading.Thread(
+                target=_send_all, args=(sock, frames, send_errors), daemon=True
+            )
+            sender.start()
+        
+        try:
+            if ack_format is not None:
+                self._confirm_format(sock, ack_format)
+            buf = self._recv_buffer()
+            for _ in range(count):
+                response_data = recv_msg(sock, buf)
+                if not response_data:
+                    raise ConnectionError("Empty response")
+                response = loads(response_data)
+                responses[response.get('request_id')] = response
+        finally:
+            if sender is not None:
+                if sender.is_alive():
+                    # Unblock a sender stuck in sendall after a failed read
+                    try:
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                sender.join()
+        if send_errors:
+            raise send_errors[0]
+    
+    def call_batch(self, calls: List[Tuple[str, Any]]) -> List[Dict]:
+        ts = datetime.now().isoformat()
+        requests = [
+            {
+                'request_id': str(uuid.uuid4()),
+                'method': method,
+                'params': params,
+                'timestamp': ts,
+                'client_id': self.client_id
+            }
+            for method, params in calls
+        ]
+        if not requests:
+            return []
+        
+        # Frames are pipelined and the responses read back as they arrive, so
+        # the batch pays roughly one round trip in total.
+        wire_format = self._format
+        try:
+            frames = encode_frames(requests, CODECS[wire_format][0])
+        except Exception as e:
+            return [_encode_error(request['request_id'], e, ts) for request in requests]
+        
+        for attempt in range(self.max_retries):
+            attempt_num = attempt + 1
+            start_time = time.time()
+            sock = None
+            
+            try:
+                conn, reused = self._acquire()
+                while True:
+                    sock, conn_format, ack_pending = conn
+                    if conn_format != wire_format:
+                        wire_format = conn_format
+                        try:
+                            frames = encode_frames(requests, CODECS[wire_format][0])
+                        except Exception as e:
+                            self._release(conn)
+                            return [_encode_error(request['request_id'], e, ts) for request in requests]
+                    responses = {}
+                    try:
+                        self._exchange_batch(
+                            sock, frames, len(requests), CODECS[conn_format][1], responses,
+                            conn_format if ack_pending else None
+                        )
+                        conn = (sock, conn_format, False)
+                        break
+                    except _FormatDeclined:
+                        sock.close()
+                        conn, reused = self._connect(self.server_port), False
+                        continue
+                    except ConnectionError:
+                        if not reused or responses:
+                            raise
+                    conn, reused = self._reconnect_stale(sock)
+                latency = time.time() - start_time
+                self._release(conn)
+                sock = None
+                break
+                
+            except Exception as e:
+                if sock is not None:
+                    sock.close()
+                logging.error("[batch of %d] ERROR on attempt %d: %s", len(requests), attempt_num, e)
+                if attempt_num < self.max_retries:
+                    # The server replays responses for request_ids it has
+                    # already executed, so resending the whole batch is safe.
+                    self._backoff(attempt)
+                    continue
+                if isinstance(e, socket.timeout):
+                    status = 'TIMEOUT_ERROR'
+                elif isinstance(e, ConnectionRefusedError):
+                    status = 'CONNECTION_ERROR'
+                else:
+                    status = 'UNKNOWN_ERROR'
+                return [
+                    {
+                        'request_id': request['request_id'],
+                        'error': str(e),
+                        'status': status,
+                        'attempts': attempt_num,
+                        'client_timestamp': ts
+                    }
+                    for request in requests
+                ]
+        
+        results = []
+        for request in requests:
+            response = responses.get(request['request_id'])
+            if response is None:
+                response = {
+                    'request_id': request['request_id'],
+                    'error': 'No response in batch',
+                    'status': 'UNKNOWN_ERROR'
+                }
+            response['latency'] = f"{latency:.3f}s"
+            response['attempt'] = attempt_num
+            response['client_timestamp'] = ts
+            results.append(response)
+        return results
+
 def demonstrate_all_scenarios(client: RPCClient, server_ip: str):
     print("\n" + "=" * 70)
     print("RPC LAB - COMPLETE DEMONSTRATION")
     print("=" * 70)
     
-    print(client.call('add', {'a': 5, 'b': 7}))
-    print(client.call('multiply', {'a': 3, 'b': 4}))
-    print(client.call('reverse_string', {'s': 'hello world'}))
-    print(client.call('get_time', {}))
-    print(client.call('non_existent_method', {'x': 1}))
+    for response in client.call_batch([
+        ('add', {'a': 5, 'b': 7}),
+        ('multiply', {'a': 3, 'b': 4}),
+        ('reverse_string', {'s': 'hello world'}),
+        ('get_time', {}),
+        ('non_existent_method', {'x': 1})
+    ]):
+        print(response)
     print(client.call('simulate_delay', {'delay_seconds': 5}))
     print(client.call('add', {'a': 2, 'b': 3}, simulate_failure=True))
     print(client.call('simulate_delay', {'delay_seconds': 1}))
@@ -172,12 +492,9 @@ if __name__ == "__main__":
     
     client = RPCClient(server_ip)
     
-    try:
-        test_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        test_sock.settimeout(2)
-        test_sock.connect((server_ip, 5000))
-        test_sock.close()
-    except:
+    # The first real call doubles as the connectivity check, and its pooled
+    # connection is reused by the demo.
+    if client.call('get_time', {}).get('status') != 'OK':
         print("Cannot connect to server")
         sys.exit(1)
     
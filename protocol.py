@@ -0,0 +1,114 @@
+import json
+import re
+import socket
+import struct
+from typing import Any, Callable, Dict, Iterable, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# The first byte a client sends on a new connection requests the payload
+# format for every frame that follows. The server answers with the byte of the
+# format it will use, falling back to JSON for formats it cannot handle. A
+# client that already knows the answer sends its first frame right behind the
+# byte instead of waiting for it.
+FORMAT_JSON = b'\x01'
+FORMAT_MSGPACK = b'\x02'
+# msgpack has no integer type wider than 64 bits, so those travel as an
+# extension holding their decimal digits.
+EXT_BIGINT = 1
+
+# Every frame is [u32 big-endian length][payload]
+HEADER = struct.Struct('>I')
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+# orjson decodes integers wider than 64 bits as lossy floats, so any payload
+# holding a run of 19+ digits (the shortest such integer) goes to the stdlib.
+_LONG_NUMBER = re.compile(rb'\d{19,}')
+
+def json_dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # orjson rejects integers wider than 64 bits; the stdlib handles them
+            pass
+    return json.dumps(obj).encode('utf-8')
+
+def json_loads(data: memoryview) -> Any:
+    if orjson is not None and not _LONG_NUMBER.search(data):
+        return orjson.loads(data)
+    # The stdlib decoder does not accept buffer objects
+    return json.loads(bytes(data))
+
+def _wrap_big_ints(obj: Any) -> Any:
+    if type(obj) is int and not -2 ** 63 <= obj < 2 ** 64:
+        return msgpack.ExtType(EXT_BIGINT, str(obj).encode('ascii'))
+    if isinstance(obj, dict):
+        return {key: _wrap_big_ints(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_wrap_big_ints(item) for item in obj]
+    return obj
+
+def _msgpack_ext_hook(code: int, data: bytes) -> Any:
+    if code == EXT_BIGINT:
+        return int(data)
+    return msgpack.ExtType(code, data)
+
+def msgpack_dumps(obj: Any) -> bytes:
+    try:
+        return msgpack.packb(obj, use_bin_type=True)
+    except OverflowError:
+        return msgpack.packb(_wrap_big_ints(obj), use_bin_type=True)
+
+def msgpack_loads(data: memoryview) -> Any:
+    return msgpack.unpackb(data, raw=False, ext_hook=_msgpack_ext_hook)
+
+# format byte -> (dumps, loads) for every format this installation can handle
+CODECS: Dict[bytes, Tuple[Callable[[Any], bytes], Callable[[memoryview], Any]]] = {
+    FORMAT_JSON: (json_dumps, json_loads)
+}
+if msgpack is not None:
+    CODECS[FORMAT_MSGPACK] = (msgpack_dumps, msgpack_loads)
+
+def frame(payload: bytes) -> bytes:
+    return HEADER.pack(len(payload)) + payload
+
+def encode_frames(objs: Iterable[Any], dumps: Callable[[Any], bytes]) -> bytes:
+    return b''.join(frame(dumps(obj)) for obj in objs)
+
+def _recv_exact_into(sock: socket.socket, view: memoryview, n: int) -> int:
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:n])
+        if not count:
+            break
+        received += count
+    return received
+
+# Reads one frame from a blocking socket into buf and returns a view of the
+# payload, which is only valid until the next read into the same buffer.
+# Frames larger than buf get a one-off buffer so a single big response does
+# not pin memory.
+def recv_msg(sock: socket.socket, buf: bytearray) -> memoryview:
+    view = memoryview(buf)
+    received = _recv_exact_into(sock, view, HEADER.size)
+    if not received:
+        return view[:0]
+    if received < HEADER.size:
+        raise ConnectionError("Connection closed mid-frame")
+    (length,) = HEADER.unpack_from(buf)
+    if length > MAX_MESSAGE_SIZE:
+        raise ConnectionError(f"Message of {length} bytes exceeds limit of {MAX_MESSAGE_SIZE}")
+    if length > len(buf):
+        view = memoryview(bytearray(length))
+    if _recv_exact_into(sock, view, length) < length:
+        raise ConnectionError("Connection closed mid-frame")
+    return view[:length]
@@ -1,24 +1,306 @@
+import os
 import socket
-import json
-import time
-import threading
+import asyncio
 import logging
+import logging.handlers
+import types
+import collections
+import inspect
+import itertools
+import queue
 from datetime import datetime
 import uuid
 
+from protocol import (
+    CODECS, FORMAT_JSON, FORMAT_MSGPACK, HEADER, MAX_MESSAGE_SIZE,
+    frame, json_dumps, json_loads, msgpack_dumps, msgpack_loads
+)
+
+# Per-request logs are emitted at DEBUG; set RPC_LOG_LEVEL=DEBUG to see them.
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.environ.get('RPC_LOG_LEVEL', 'INFO').upper(),
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+class _Codec:
+    def __init__(self, dumps, loads, error_tpl):
+        self.dumps = dumps
+        self.loads = loads
+        # Error responses share one shape, so only the variable fields are
+        # encoded per request and spliced between pre-serialized pieces.
+        self.error_tpl = error_tpl
+        self.unknown_id = dumps('unknown')
+        self.request_id_required = dumps('request_id is required')
+        self.request_id_not_string = dumps('request_id must be a string')
+        self.method_required = dumps('method is required')
+    
+    def error_payload(self, request_id, error, now_iso):
+        head, mid, tail, end = self.error_tpl
+        return b''.join((head, request_id, mid, error, tail, self.dumps(now_iso), end))
+
+_CODECS = {
+    FORMAT_JSON: _Codec(
+        json_dumps,
+        json_loads,
+        (b'{"request_id":', b',"error":', b',"status":"ERROR","server_timestamp":', b'}')
+    )
+}
+if FORMAT_MSGPACK in CODECS:
+    _CODECS[FORMAT_MSGPACK] = _Codec(
+        msgpack_dumps,
+        msgpack_loads,
+        (
+            b'\x84' + msgpack_dumps('request_id'),
+            msgpack_dumps('error'),
+            msgpack_dumps('status') + msgpack_dumps('ERROR') + msgpack_dumps('server_timestamp'),
+            b''
+        )
+    )
+
+# Connection receive buffers start small and grow while frames queue up; past
+# RECV_BUFFER_SIZE of buffered data the connection stops reading.
+INITIAL_RECV_BUFFER_SIZE = 4096
+RECV_BUFFER_SIZE = 65536
+MAX_RECENT = 10_000
+# While clients wait for a slot, connections idle for this many seconds are
+# closed to make room. Pooled clients reconnect transparently.
+IDLE_EVICT_AFTER = 1.0
+_METHOD_NOT_FOUND = 'Method "%s" not found. Available methods: %s'
+
+def _send_msg(conn, payload):
+    conn.write(frame(payload))
+
+# The event loop receives straight into a per-connection buffer through
+# BufferedProtocol (asyncio's recv_into), and frames are decoded from
+# memoryviews of it instead of the fresh bytes StreamReader hands out. The
+# buffer only exists while data is pending, so idle connections hold none.
+class _Connection(asyncio.BufferedProtocol):
+    def __init__(self, handler, loop, idle):
+        self._handler = handler
+        self._loop = loop
+        self._idle = idle
+        self._buf = None
+        self._view = None
+        # Unconsumed data is self._buf[self._start:self._end]
+        self._start = 0
+        self._end = 0
+        # Bytes the waiting reader needs buffered before it can continue
+        self._need = 0
+        self._eof = False
+        self._lost = False
+        self._exc = None
+        self._read_waiter = None
+        self._drain_waiter = None
+        self._reading_paused = False
+        self._writing_paused = False
+        self.transport = None
+        self._task = None
+    
+    def _set_buffer(self, buf):
+        self._buf = buf
+        self._view = memoryview(buf)
+    
+    def _wake_reader(self):
+        waiter = self._read_waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+    
+    def connection_made(self, transport):
+        self.transport = transport
+        self._task = self._loop.create_task(self._handler(self))
+    
+    def get_buffer(self, sizehint):
+        if self._buf is None:
+            self._set_buffer(bytearray(max(INITIAL_RECV_BUFFER_SIZE, self._need)))
+            return self._view
+        if self._start:
+            # Move the partial frame to the front to make room behind it
+            pending = self._end - self._start
+            self._buf[:pending] = self._buf[self._start:self._end]
+            self._start, self._end = 0, pending
+        size = len(self._buf)
+        if self._end == size or self._need > size:
+            buf = bytearray(max(self._need, size * 2))
+            buf[:self._end] = self._view[:self._end]
+            self._set_buffer(buf)
+        return self._view[self._end:]
+    
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+        buffered = self._end - self._start
+        if buffered >= self._need:
+            self._wake_reader()
+        if buffered >= RECV_BUFFER_SIZE and buffered >= self._need:
+            # Enough frames queued that the handler has not got to yet; stop
+            # reading until it needs more
+            self._reading_paused = True
+            self.transport.pause_reading()
+    
+    def eof_received(self):
+        self._eof = True
+        self._wake_reader()
+        # Keep the transport open so pending responses can still be written
+        return True
+    
+    def connection_lost(self, exc):
+        self._eof = self._lost = True
+        self._exc = exc
+        self._wake_reader()
+        waiter = self._drain_waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+    
+    def pause_writing(self):
+        self._writing_paused = True
+    
+    def resume_writing(self):
+        self._writing_paused = False
+        waiter = self._drain_waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+    
+    def write(self, data):
+        self.transport.write(data)
+    
+    async def drain(self):
+        if self._writing_paused and not self._lost:
+            self._drain_waiter = self._loop.create_future()
+            try:
+                await self._drain_waiter
+            finally:
+                self._drain_waiter = None
+        if self._lost:
+            raise ConnectionResetError("Connection lost")
+    
+    async def _fill(self, n):
+        # Wait until n unconsumed bytes are buffered; False on EOF before that
+        while self._end - self._start < n:
+            if self._exc is not None:
+                raise self._exc
+            if self._eof:
+                return False
+            idle = self._start == self._end
+            if idle:
+                # Nothing pending, so the buffer is dropped while we wait
+                self._buf = self._view = None
+                self._start = self._end = 0
+                self._idle[self] = self._loop.time()
+            self._need = n
+            if self._reading_paused:
+                self._reading_paused = False
+                self.transport.resume_reading()
+            self._read_waiter = self._loop.create_future()
+            try:
+                await self._read_waiter
+            finally:
+                self._read_waiter = None
+                self._need = 0
+                if idle:
+                    self._idle.pop(self, None)
+        return True
+    
+    async def read_byte(self):
+        if not await self._fill(1):
+            return b''
+        self._start += 1
+        return bytes(self._buf[self._start - 1:self._start])
+    
+    async def read_frame(self):
+        # The returned view points into the receive buffer, so it is only
+        # valid until the handler next yields to the event loop.
+        if not await self._fill(HEADER.size):
+            if self._end > self._start:
+                raise ConnectionError("Connection closed mid-frame")
+            return b''
+        (length,) = HEADER.unpack_from(self._buf, self._start)
+        if length > MAX_MESSAGE_SIZE:
+            raise ConnectionError(f"Message of {length} bytes exceeds limit of {MAX_MESSAGE_SIZE}")
+        if not await self._fill(HEADER.size + length):
+            raise ConnectionError("Connection closed mid-frame")
+        start = self._start + HEADER.size
+        self._start = start + length
+        return self._view[start:self._start]
+
+def _start_log_listener():
+    # Route records through a queue so handler I/O happens on the listener
+    # thread instead of blocking the event loop.
+    root = logging.getLogger()
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    listener.start()
+    return listener
+
+def _stop_log_listener(listener):
+    listener.stop()
+    logging.getLogger().handlers = list(listener.handlers)
+
+def _call_generic(method, params):
+    if isinstance(params, dict):
+        return method(**params)
+    elif isinstance(params, list):
+        return method(*params)
+    else:
+        return method(params)
+
+# For methods with plain positional parameters, generate an invoker that pulls
+# each argument straight out of the params dict instead of building kwargs for
+# method(**params). Other signatures, and params that do not match exactly, go
+# through _call_generic so errors read the same as a normal call.
+def _build_invoker(method):
+    params = inspect.signature(method).parameters.values()
+    if any(p.kind is not p.POSITIONAL_OR_KEYWORD or p.default is not p.empty for p in params):
+        return lambda p: _call_generic(method, p)
+    
+    names = [p.name for p in params]
+    if names:
+        # The parameter names only appear as dict keys; the locals are generated
+        # so a parameter called p or _method cannot shadow the invoker's own names.
+        args = [f"_a{i}" for i in range(len(names))]
+        fetch = "; ".join(f"{arg} = p[{name!r}]" for arg, name in zip(args, names))
+        src = (
+            f"def _invoke(p):\n"
+            f"    if type(p) is dict and len(p) == {len(names)}:\n"
+            f"        try:\n"
+            f"            {fetch}\n"
+            f"        except KeyError:\n"
+            f"            pass\n"
+            f"        else:\n"
+            f"            return _method({', '.join(args)})\n"
+            f"    return _call_generic(_method, p)\n"
+        )
+    else:
+        src = (
+            "def _invoke(p):\n"
+            "    if type(p) is dict and not p:\n"
+            "        return _method()\n"
+            "    return _call_generic(_method, p)\n"
+        )
+    namespace = {'_method': method, '_call_generic': _call_generic}
+    exec(src, namespace)
+    return namespace['_invoke']
+
 class RPCServer:
-    def __init__(self, host='0.0.0.0', port=5000):
+    def __init__(self, host='0.0.0.0', port=5000, max_clients=1024):
         self.host = host
         self.port = port
-        self.server_socket = None
+        self.max_clients = max_clients
         self.running = False
-        self.request_count = 0
-        self.methods = {
+        self._server = None
+        self._loop = None
+        self._slots = None
+        # connection -> loop time it went idle (waiting for a request with
+        # nothing buffered), oldest first
+        self._idle = collections.OrderedDict()
+        self._waiting = 0
+        self._evict_timer = None
+        self._counter = itertools.count(1)
+        # (client_id, request_id) -> future of (codec, encoded response), so a
+        # retried request replays the original answer instead of executing the
+        # method again.
+        # Only touched from the event loop thread, so no lock is needed.
+        self._recent = collections.OrderedDict()
+        self._methods = {
             'add': self.add,
             'multiply': self.multiply,
             'get_time': self.get_time,
@@ -26,167 +308,255 @@ class RPCServer:
             'simulate_delay': self.simulate_delay,
             'echo': self.echo
         }
+        self.methods = types.MappingProxyType(self._methods)
+        self._invokers = {name: _build_invoker(method) for name, method in self._methods.items()}
+        self._method_list_str = str(list(self._methods.keys()))
     
     def add(self, a, b):
         result = a + b
-        logging.info(f"add({a}, {b}) = {result}")
+        logging.debug("add(%s, %s) = %s", a, b, result)
         return result
     
     def multiply(self, a, b):
         result = a * b
-        logging.info(f"multiply({a}, {b}) = {result}")
+        logging.debug("multiply(%s, %s) = %s", a, b, result)
         return result
     
     def get_time(self):
         result = datetime.now().isoformat()
-        logging.info(f"get_time() = {result}")
+        logging.debug("get_time() = %s", result)
         return result
     
     def reverse_string(self, s):
         result = s[::-1]
-        logging.info(f"reverse_string('{s}') = '{result}'")
+        logging.debug("reverse_string('%s') = '%s'", s, result)
         return result
     
-    def simulate_delay(self, delay_seconds):
-        logging.warning(f"Simulating delay of {delay_seconds} seconds...")
-        time.sleep(delay_seconds)
+    async def simulate_delay(self, delay_seconds):
+        logging.warning("Simulating delay of %s seconds...", delay_seconds)
+        await asyncio.sleep(delay_seconds)
         result = f"Slept for {delay_seconds} seconds"
-        logging.info(f"Delay completed: {result}")
+        logging.debug("Delay completed: %s", result)
         return result
     
     def echo(self, message):
-        logging.info(f"echo('{message}')")
+        logging.debug("echo('%s')", message)
         return f"Echo: {message}"
     
-    def handle_client(self, client_socket, address):
+    def _evict_idle(self):
+        # Runs while clients wait for a slot: closes one long-idle connection
+        # per waiting client, then checks again when the next one qualifies.
+        self._evict_timer = None
+        if not self._waiting:
+            return
+        deadline = self._loop.time() - IDLE_EVICT_AFTER
+        evicted = 0
+        while evicted < self._waiting and self._idle:
+            conn, since = next(iter(self._idle.items()))
+            if since > deadline:
+                break
+            del self._idle[conn]
+            conn.transport.close()
+            evicted += 1
+        if evicted < self._waiting:
+            delay = IDLE_EVICT_AFTER
+            if self._idle:
+                delay = next(iter(self._idle.values())) - deadline
+            self._evict_timer = self._loop.call_later(delay, self._evict_idle)
+    
+    async def _handle(self, conn):
+        transport = conn.transport
+        address = transport.get_extra_info('peername')
         client_id = f"{address[0]}:{address[1]}"
-        logging.info(f"New client connected: {client_id}")
+        logging.info("New client connected: %s", client_id)
+        
+        client_socket = transport.get_extra_info('socket')
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_NODELAY'):
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        
+        invokers = self._invokers
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        recent = self._recent
+        slots = self._slots
+        has_slot = False
         
         try:
+            # Connections beyond max_clients wait here for a free slot, which
+            # pushes back on clients instead of growing without bound. An idle
+            # connection, e.g. a client's pooled socket, gives up its slot so
+            # it cannot starve clients with work to do.
+            if slots.locked():
+                # Logged once per overload, not once per waiting client
+                if not self._waiting:
+                    logging.warning("Client limit of %d reached, new clients wait for a slot", self.max_clients)
+                self._waiting += 1
+                try:
+                    if self._evict_timer is None:
+                        self._evict_idle()
+                    await slots.acquire()
+                finally:
+                    self._waiting -= 1
+                    if not self._waiting:
+                        logging.info("No clients waiting for a slot any more")
+            else:
+                await slots.acquire()
+            has_slot = True
+            
+            wire_format = await conn.read_byte()
+            if not wire_format:
+                return
+            codec = _CODECS.get(wire_format)
+            if codec is None:
+                logging.info("Client %s requested unsupported wire format %r, using JSON", client_id, wire_format)
+                wire_format = FORMAT_JSON
+                codec = _CODECS[wire_format]
+            conn.write(wire_format)
+            
             while True:
-                data = client_socket.recv(4096)
+                data = await conn.read_frame()
                 if not data:
                     break
                 
-                self.request_count += 1
+                req_no = next(self._counter)
+                
+                now_iso = datetime.now().isoformat()
                 
                 try:
-                    request = json.loads(data.decode('utf-8'))
+                    request = codec.loads(data)
                     request_id = request.get('request_id')
                     method_name = request.get('method')
                     params = request.get('params', {})
                     timestamp = request.get('timestamp')
                     
-                    logging.info(f"[Req #{self.request_count}] ID: {request_id}, Method: {method_name}")
+                    if debug:
+                        logging.debug("[Req #%d] ID: %s, Method: %s", req_no, request_id, method_name)
+                    
+                    invoker = invokers.get(method_name) if type(method_name) is str else None
                     
                     if not request_id:
-                        response = {
-                            'request_id': 'unknown',
-                            'error': 'request_id is required',
-                            'status': 'ERROR',
-                            'server_timestamp': datetime.now().isoformat()
-                        }
+                        payload = codec.error_payload(codec.unknown_id, codec.request_id_required, now_iso)
+                    elif type(request_id) is not str:
+                        payload = codec.error_payload(codec.dumps(request_id), codec.request_id_not_string, now_iso)
                     elif not method_name:
-                        response = {
-                            'request_id': request_id,
-                            'error': 'method is required',
-                            'status': 'ERROR',
-                            'server_timestamp': datetime.now().isoformat()
-                        }
-                    elif method_name not in self.methods:
-                        response = {
-                            'request_id': request_id,
-                            'error': f'Method \"{method_name}\" not found',
-                            'status': 'ERROR',
-                            'server_timestamp': datetime.now().isoformat()
-                        }
+                        payload = codec.error_payload(codec.dumps(request_id), codec.method_required, now_iso)
+                    elif invoker is None:
+                        payload = codec.error_payload(
+                            codec.dumps(request_id),
+                            codec.dumps(_METHOD_NOT_FOUND % (method_name, self._method_list_str)),
+                            now_iso
+                        )
                     else:
-                        try:
-                            method = self.methods[method_name]
-                            
-                            if isinstance(params, dict):
-                                result = method(**params)
-                            elif isinstance(params, list):
-                                result = method(*params)
-                            else:
-                                result = method(params)
+                        # request_ids are only unique per client
+                        sender = request.get('client_id')
+                        key = (sender if type(sender) is str else None, request_id)
+                        pending = recent.get(key)
+                        if pending is not None:
+                            recent.move_to_end(key)
+                            if debug:
+                                logging.debug("[Req #%d] Replaying response for %s", req_no, request_id)
+                            cached_codec, payload = await asyncio.shield(pending)
+                            if cached_codec is not codec:
+                                payload = codec.dumps(cached_codec.loads(payload))
+                        else:
+                            pending = self._loop.create_future()
+                            recent[key] = pending
+                            if len(recent) > MAX_RECENT:
+                                recent.popitem(last=False)
                             
-                            response = {
-                                'request_id': request_id,
-                                'result': result,
-                                'status': 'OK',
-                                'server_timestamp': datetime.now().isoformat(),
-                                'request_timestamp': timestamp
-                            }
+                            try:
+                                result = invoker(params)
+                                
+                                if asyncio.iscoroutine(result):
+                                    result = await result
+                                
+                                payload = codec.dumps({
+                                    'request_id': request_id,
+                                    'result': result,
+                                    'status': 'OK',
+                                    'server_timestamp': now_iso,
+                                    'request_timestamp': timestamp
+                                })
+                                
+                                if debug:
+                                    logging.debug("[Req #%d] Success: %s", req_no, method_name)
                             
-                            logging.info(f"[Req #{self.request_count}] Success: {method_name}")
+                            except TypeError as e:
+                                payload = codec.error_payload(codec.dumps(request_id), codec.dumps(str(e)), now_iso)
+                            except Exception as e:
+                                payload = codec.error_payload(codec.dumps(request_id), codec.dumps(str(e)), now_iso)
+                            except asyncio.CancelledError:
+                                pending.cancel()
+                                if recent.get(key) is pending:
+                                    del recent[key]
+                                raise
                             
-                        except TypeError as e:
-                            response = {
-                                'request_id': request_id,
-                                'error': str(e),
-                                'status': 'ERROR',
-                                'server_timestamp': datetime.now().isoformat()
-                            }
-                        except Exception as e:
-                            response = {
-                                'request_id': request_id,
-                                'error': str(e),
-                                'status': 'ERROR',
-                                'server_timestamp': datetime.now().isoformat()
-                            }
+                            pending.set_result((codec, payload))
                     
-                    client_socket.send(json.dumps(response).encode('utf-8'))
+                    _send_msg(conn, payload)
+                    await conn.drain()
                     
-                except json.JSONDecodeError as e:
-                    error_response = {
-                        'request_id': 'unknown',
-                        'error': str(e),
-                        'status': 'ERROR',
-                        'server_timestamp': datetime.now().isoformat()
-                    }
-                    client_socket.send(json.dumps(error_response).encode('utf-8'))
+                except ValueError as e:
+                    # JSONDecodeError and msgpack's unpack errors are both ValueErrors
+                    _send_msg(conn, codec.error_payload(codec.unknown_id, codec.dumps(str(e)), now_iso))
+                    await conn.drain()
                     
+        except asyncio.CancelledError:
+            pass
         except ConnectionResetError:
-            logging.warning(f"Client {client_id} disconnected unexpectedly")
+            logging.warning("Client %s disconnected unexpectedly", client_id)
         except Exception as e:
-            logging.error(f"Error handling client {client_id}: {e}")
+            logging.error("Error handling client %s: %s", client_id, e)
         finally:
-            client_socket.close()
-            logging.info(f"Client {client_id} disconnected")
+            if has_slot:
+                slots.release()
+            # Any responses still buffered are flushed before the socket closes
+            transport.close()
+            logging.info("Client %s disconnected", client_id)
     
-    def start(self):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.max_clients)
+        self._server = await self._loop.create_server(
+            lambda: _Connection(self._handle, self._loop, self._idle),
+            self.host,
+            self.port,
+            reuse_address=True,
+            backlog=socket.SOMAXCONN
+        )
+        for sock in self._server.sockets:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_NODELAY'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.running = True
         
         logging.info("=" * 60)
         logging.info("RPC Server Started")
-        logging.info(f"Host: {self.host}:{self.port}")
-        logging.info(f"Available Methods: {list(self.methods.keys())}")
+        logging.info("Host: %s:%s", self.host, self.port)
+        logging.info("Available Methods: %s", self._method_list_str)
         logging.info("=" * 60)
         
         try:
-            while self.running:
-                client_socket, address = self.server_socket.accept()
-                threading.Thread(
-                    target=self.handle_client,
-                    args=(client_socket, address),
-                    daemon=True
-                ).start()
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+    
+    def start(self):
+        listener = _start_log_listener()
+        try:
+            asyncio.run(self._serve())
         except KeyboardInterrupt:
             logging.info("Server shutting down")
         except Exception as e:
-            logging.error(f"Server error: {e}")
+            logging.error("Server error: %s", e)
         finally:
             self.stop()
+            _stop_log_listener(listener)
     
     def stop(self):
         self.running = False
-        if self.server_socket:
-            self.server_socket.close()
+        if self._server and self._loop and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._server.close)
         logging.info("Server stopped")
 
 if __name__ == "__main__":